@@ -0,0 +1,56 @@
+#!/usr/bin/python
+
+import argparse
+import os
+
+from tfe_archive_index import ArchiveIndex
+
+# Optional
+parser = argparse.ArgumentParser(description='Confirm the archives published by this build.')
+parser.add_argument('-tfePipelineState',
+                    default='tfepipelinestate.db',
+                    help="The pipeline state file (run history, published archive index, pre-flight parse cache) carried between builds.")
+
+
+def parse_args(parser):
+    """
+    Get all arguments.
+    :param parser: ArgumentParser
+    :return: Settings as NameSpace
+    """
+    print(f'##[group]Parse Arguments')
+    print(f'##[command]Parsing arguments')
+    args = parser.parse_args()
+
+    args.tfePipelineState = os.path.abspath(args.tfePipelineState)
+    print(f'##[debug]tfePipelineState:{args.tfePipelineState}')
+
+    # Build specific values
+    args.adoBuildId = os.environ["BUILD_BUILDID"]
+
+    print(f'##[endgroup]')
+    print()
+    return args
+
+
+def confirm_archives(settings):
+    """
+    ADO uploads the artifacts of a step before the next step starts, and fails the step when an upload fails.
+    Running after the plan step succeeded means its archives were uploaded, so later builds may point to them.
+    :param settings: All settings
+    :return: None
+    """
+    print(f'##[group]Confirm Published Archives')
+
+    index = ArchiveIndex(settings.tfePipelineState)
+    count = index.confirm(settings.adoBuildId)
+    index.close()
+    print(f'##[command]Archives confirmed for build {settings.adoBuildId}: {count}')
+
+    print(f'##[endgroup]')
+    print()
+
+
+settings = parse_args(parser)
+
+confirm_archives(settings)
@@ -4,10 +4,14 @@ import argparse
 import json
 import os
 import re
+import sys
 import time
 
 import requests
 
+from tfe_run_cancel import Deadline, RunCancelled, cancel_run, install_signal_handlers
+from tfe_run_history import RunHistory, get_resource_counts, get_status_durations
+
 # Required, these can be set via arguments or environment variables
 parser = argparse.ArgumentParser(description='Perform a TFE Run Plan.')
 parser.add_argument('-tfeToken',
@@ -25,6 +29,13 @@ parser.add_argument('-tfeWorkspaceName',
 parser.add_argument('-tfeRunId',
                     default=os.environ.get('TFERUNID'),
                     help="TFE Run Id (i.e. run-xxxxxxxxx)")
+# Optional
+parser.add_argument('-tfePipelineState',
+                    default='tfepipelinestate.db',
+                    help="The pipeline state file (run history, published archive index, pre-flight parse cache) carried between builds.")
+parser.add_argument('-tfeDeadlineMinutes',
+                    default='0',
+                    help="When greater than 0, cancel or discard the TFE Run if the apply has not completed in this many minutes.")
 
 
 def parse_args(parser):
@@ -55,8 +66,16 @@ def parse_args(parser):
     print(f'##[debug]tfeWorkspaceName:{args.tfeWorkspaceName}')
     print(f'##[debug]tfeRunId:{args.tfeRunId}')
 
+    args.tfePipelineState = os.path.abspath(args.tfePipelineState)
+    print(f'##[debug]tfePipelineState:{args.tfePipelineState}')
+    args.tfeDeadlineMinutes = float(args.tfeDeadlineMinutes)
+    args.tfeDeadline = Deadline(args.tfeDeadlineMinutes)
+    print(f'##[debug]tfeDeadlineMinutes:{args.tfeDeadlineMinutes}')
+
     # Build specific values
     args.sleepInSeconds = 5
+    args.slowRunFactor = 2
+    args.tfeHistory = RunHistory(args.tfePipelineState)
     args.adoBuildId = os.environ["BUILD_BUILDID"]
 
     print(f'##[endgroup]')
@@ -142,10 +161,28 @@ def wait_for_apply_complete(settings):
                         )
     currentRunStatus = resp.json()['data']['attributes']['status']
 
+    # Use previous runs of this workspace to time the polls, never to stop the apply.
+    # Past applies may have been no-ops, stopping an apply part way is left to -tfeDeadlineMinutes
+    prediction = settings.tfeHistory.predict(settings.tfeWorkspaceName, 'apply')
+    if prediction is None:
+        print(f'##[command]Not enough run history to predict the apply duration')
+    else:
+        print(f'##[command]Apply predicted to take {prediction.median:.0f}s (p95 {prediction.p95:.0f}s, {prediction.samples} runs)')
+
     # Loop until plan, cost estimate, and policy checks are all done (if applicable)
+    startTime = time.monotonic()
+    isSlowRun = False
     planDone = checkStatus(currentRunStatus)
     while planDone is False:
-        time.sleep(settings.sleepInSeconds)
+        elapsed = time.monotonic() - startTime
+        if prediction is not None and not isSlowRun and elapsed > prediction.median * settings.slowRunFactor:
+            isSlowRun = True
+            print(f'##vso[task.logissue type=warning]TFE Run Apply is much slower than usual, {elapsed:.0f}s so far vs a typical {prediction.median:.0f}s')
+
+        if prediction is None:
+            settings.tfeDeadline.sleep(settings.sleepInSeconds)
+        else:
+            settings.tfeDeadline.sleep(prediction.next_poll_in_seconds(elapsed, settings.sleepInSeconds))
         resp = requests.get(f'https://{settings.tfeHostName}/api/v2/runs/{settings.tfeRunId}',
                             headers={'Authorization': f'Bearer {settings.tfeToken}',
                                      'Content-Type': 'application/vnd.api+json'},
@@ -156,6 +193,10 @@ def wait_for_apply_complete(settings):
         planDone = checkStatus(currentRunStatus)
 
     print(f'##[command]Plan has completed, status: {currentRunStatus}')
+
+    vars(settings)['tfeRunStatus'] = currentRunStatus
+    vars(settings)['tfeRunDuration'] = time.monotonic() - startTime
+    vars(settings)['tfeStatusDurations'] = get_status_durations(resp.json()['data']['attributes'].get('status-timestamps', {}))
     print(f'##[endgroup]')
     print()
 
@@ -171,6 +212,7 @@ def get_run_apply_logs(settings):
     print(f'##[debug]getApplyLogsUrlResponse: {resp.text}')
 
     vars(settings)['applyLogsUrl'] = resp.json()['data']['attributes']['log-read-url']
+    vars(settings)['tfeResourceCounts'] = get_resource_counts(resp.json()['data']['attributes'])
 
     print(f'##[command]Getting Run Apply Logs')
     resp = requests.get(settings.applyLogsUrl,
@@ -212,6 +254,20 @@ def create_summary(settings):
     print()
 
 
+def record_run_history(settings):
+    print(f'##[group]Record Run History')
+
+    print(f'##[command]Recording apply duration: {settings.tfeRunDuration:.0f}s')
+    print(f'##[debug]tfeStatusDurations: {settings.tfeStatusDurations}')
+    print(f'##[debug]tfeResourceCounts: {settings.tfeResourceCounts}')
+    settings.tfeHistory.record(settings.tfeWorkspaceName, settings.tfeRunId, 'apply', settings.tfeRunStatus,
+                               settings.tfeRunDuration, settings.tfeStatusDurations, settings.tfeResourceCounts)
+    settings.tfeHistory.close()
+
+    print(f'##[endgroup]')
+    print()
+
+
 # Utility functions
 def checkStatus(status):
     """
@@ -247,12 +303,21 @@ def printLogs(logs):
 
 settings = parse_args(parser)
 
-validate_run_id(settings)
+# Stop the TFE Run if the ADO job is cancelled, times out, or the deadline is reached
+install_signal_handlers()
+
+try:
+    validate_run_id(settings)
+
+    create_run_apply(settings)
 
-create_run_apply(settings)
+    wait_for_apply_complete(settings)
 
-wait_for_apply_complete(settings)
+    get_run_apply_logs(settings)
 
-get_run_apply_logs(settings)
+    record_run_history(settings)
 
-create_summary(settings)
+    create_summary(settings)
+except RunCancelled as e:
+    cancel_run(settings, e)
+    sys.exit(1)
@@ -0,0 +1,397 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from tfe_run_cancel import Deadline, stop_run
+
+# Required, these can be set via arguments or environment variables
+parser = argparse.ArgumentParser(description='Perform TFE Runs across dependent workspaces.')
+parser.add_argument('-tfeToken',
+                    default=os.environ.get('TFETOKEN'),
+                    help='API Token used to authenticate to TFE.')
+parser.add_argument('-tfeHostName',
+                    default=os.environ.get('TFEHOSTNAME'),
+                    help="TFE Hostname (i.e. terraform.company.com)")
+parser.add_argument('-tfeOrganizationName',
+                    default=os.environ.get('TFEORGANIZATIONNAME'),
+                    help="TFE Organization Name (i.e. hashicorp-dev)")
+parser.add_argument('-tfeManifest',
+                    default=os.environ.get('TFEMANIFEST'),
+                    help='The path of the workspace dependency manifest (json) based on current working directory.')
+parser.add_argument('-terraformWorkingDirectory',
+                    default=os.environ.get('TERRAFORMWORKINGDIRECTORY'),
+                    help='The path that manifest working directories are relative to, based on current working directory.')
+# Optional
+parser.add_argument('-tfeSpeculativePlan',
+                    default='False',
+                    help="When True, trigger speculative plans that can not be applied.")
+parser.add_argument('-tfeDestroyPlan',
+                    default='False',
+                    help="When True, trigger destroy plans and walk the dependencies in reverse.")
+parser.add_argument('-tfeMaxParallel',
+                    default='4',
+                    help="Maximum number of workspaces to run at the same time.")
+parser.add_argument('-tfePipelineState',
+                    default='tfepipelinestate.db',
+                    help="The pipeline state file (run history, published archive index, pre-flight parse cache) carried between builds.")
+parser.add_argument('-tfePreflightParse',
+                    default='True',
+                    help="True to fail on Terraform files that do not parse, Warn to only report them, False to skip parsing.")
+parser.add_argument('-tfeDeadlineMinutes',
+                    default='0',
+                    help="When greater than 0, cancel or discard any TFE Run still in flight after this many minutes.")
+parser.add_argument('-tfeArchiveChunkSizeMB',
+                    default='0',
+                    help="When greater than 0, publish archives larger than this as chunks of this size.")
+parser.add_argument('-tfeMaxArchiveSizeMB',
+                    default='100',
+                    help="Fail a workspace before archiving when its files to archive are larger than this in total.")
+parser.add_argument('-tfeMaxFileCount',
+                    default='10000',
+                    help="Fail a workspace before archiving when it has more files to archive than this.")
+parser.add_argument('-tfeRunTimeoutMinutes',
+                    default='60',
+                    help="Minutes a plan may spend working when there is not enough run history to predict it.")
+parser.add_argument('-tfeRunTimeoutFactor',
+                    default='3',
+                    help="Time out a plan when it takes this many times longer than the slowest recent plans.")
+
+
+def parse_args(parser):
+    """
+    Get all required arguments and valid them.
+    Throw exception if any arguments were not set
+    :param parser: ArgumentParser
+    :return: Settings as NameSpace
+    """
+    print(f'##[group]Parse Arguments')
+    print(f'##[command]Parsing arguments')
+    try:
+        args = parser.parse_args()
+        args_as_dict = vars(args)
+        for k in args_as_dict:
+            if args_as_dict[k] is None:
+                print(f'##[error]Missing argument: {k}')
+        if None in args_as_dict.values():
+            raise Exception('Missing required arguments')
+    except Exception:
+        parser.print_help()
+        raise
+    # Print arguments for debugging
+    print(f'##[debug]tfeManifest:{args.tfeManifest}')
+    print(f'##[debug]terraformWorkingDirectory:{args.terraformWorkingDirectory}')
+    print(f'##[debug]tfeToken:{args.tfeToken}')
+    print(f'##[debug]tfeHostName:{args.tfeHostName}')
+    print(f'##[debug]tfeOrganizationName:{args.tfeOrganizationName}')
+
+    # Update in case ADO boolean matching causes issues
+    args.tfeSpeculativePlan = json.loads(args.tfeSpeculativePlan.lower())
+    args.tfeDestroyPlan = json.loads(args.tfeDestroyPlan.lower())
+    args.tfeMaxParallel = int(args.tfeMaxParallel)
+    print(f'##[debug]tfeSpeculativePlan:{args.tfeSpeculativePlan}')
+    print(f'##[debug]tfeDestroyPlan:{args.tfeDestroyPlan}')
+    print(f'##[debug]tfeMaxParallel:{args.tfeMaxParallel}')
+    print(f'##[debug]tfePreflightParse:{args.tfePreflightParse}')
+    print(f'##[debug]tfeArchiveChunkSizeMB:{args.tfeArchiveChunkSizeMB}')
+    print(f'##[debug]tfeMaxArchiveSizeMB:{args.tfeMaxArchiveSizeMB}')
+    print(f'##[debug]tfeMaxFileCount:{args.tfeMaxFileCount}')
+    print(f'##[debug]tfeRunTimeoutMinutes:{args.tfeRunTimeoutMinutes}')
+    print(f'##[debug]tfeRunTimeoutFactor:{args.tfeRunTimeoutFactor}')
+
+    # Workspaces run in their own directory, share a single pipeline state file
+    args.tfePipelineState = os.path.abspath(args.tfePipelineState)
+    print(f'##[debug]tfePipelineState:{args.tfePipelineState}')
+    args.tfeDeadlineMinutes = float(args.tfeDeadlineMinutes)
+    args.tfeDeadline = Deadline(args.tfeDeadlineMinutes)
+    print(f'##[debug]tfeDeadlineMinutes:{args.tfeDeadlineMinutes}')
+
+    # Build specific values
+    args.scriptDirectory = os.path.dirname(os.path.abspath(__file__))
+    args.outputLock = threading.Lock()
+    args.processLock = threading.Lock()
+    args.processes = set()
+    args.cancelReason = None
+
+    print(f'##[endgroup]')
+    print()
+    return args
+
+
+def load_manifest(settings):
+    """
+    Read the dependency manifest and build the graph of workspaces.
+    The manifest is a json object keyed by TFE Workspace Name:
+    {
+      "workspaces": {
+        "network": { "workingDirectory": "network" },
+        "app":     { "workingDirectory": "app", "dependsOn": ["network"] }
+      }
+    }
+    For a destroy the edges are reversed, dependents are destroyed before what they depend on.
+    :param settings: All settings
+    :return: None
+    """
+    print(f'##[group]Load Dependency Manifest')
+
+    print(f'##[command]Reading manifest: {settings.tfeManifest}')
+    with open(settings.tfeManifest) as f:
+        manifest = json.load(f)
+    workspaces = manifest['workspaces']
+
+    dependsOn = {}
+    for name, workspace in workspaces.items():
+        dependsOn[name] = set(workspace.get('dependsOn', []))
+        for dependency in dependsOn[name]:
+            if dependency not in workspaces:
+                exceptionMessage = f'Workspace "{name}" depends on unknown workspace "{dependency}"'
+                print(f'##[error]Invalid Manifest: {exceptionMessage}')
+                raise Exception(exceptionMessage)
+
+    if settings.tfeDestroyPlan:
+        print(f'##[command]Destroy requested, reversing dependency order')
+        reversedDependsOn = {name: set() for name in dependsOn}
+        for name, dependencies in dependsOn.items():
+            for dependency in dependencies:
+                reversedDependsOn[dependency].add(name)
+        dependsOn = reversedDependsOn
+
+    vars(settings)['tfeWorkspaces'] = workspaces
+    vars(settings)['tfeDependsOn'] = dependsOn
+    vars(settings)['tfeRunOrder'] = get_run_order(dependsOn)
+    for level, names in enumerate(settings.tfeRunOrder):
+        print(f'##[debug]Level {level}: {", ".join(names)}')
+
+    print(f'##[endgroup]')
+    print()
+
+
+def run_workspaces(settings):
+    """
+    Schedule every workspace as soon as all of its dependencies have succeeded.
+    A failed workspace causes everything downstream of it to be skipped.
+    :param settings: All settings
+    :return: None
+    """
+    print(f'##[group]Run Workspaces')
+
+    results = {}
+    running = {}
+    pending = set(settings.tfeDependsOn)
+    with ThreadPoolExecutor(max_workers=settings.tfeMaxParallel) as executor:
+        while pending or running:
+            for name in sorted(pending):
+                dependencies = settings.tfeDependsOn[name]
+                if settings.cancelReason is None and settings.tfeDeadline.remaining_in_seconds() == 0:
+                    settings.cancelReason = f'Deadline of {settings.tfeDeadlineMinutes} minutes reached'
+                if settings.cancelReason is not None:
+                    print(f'##[warning]Skipping workspace {name}, {settings.cancelReason}')
+                    results[name] = 'cancelled'
+                    pending.remove(name)
+                elif any(results.get(d) in ['failed', 'skipped', 'cancelled'] for d in dependencies):
+                    print(f'##[warning]Skipping workspace {name}, an upstream workspace did not succeed')
+                    results[name] = 'skipped'
+                    pending.remove(name)
+                elif all(results.get(d) == 'succeeded' for d in dependencies):
+                    print(f'##[command]Starting workspace: {name}')
+                    running[executor.submit(run_workspace, settings, name)] = name
+                    pending.remove(name)
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = 'succeeded' if future.result() else 'failed'
+                print(f'##[command]Workspace {name} {results[name]}')
+
+    vars(settings)['tfeResults'] = results
+    print(f'##[endgroup]')
+    print()
+
+
+def run_workspace(settings, name):
+    """
+    Run the plan script, and the apply script when not speculative, for a single workspace.
+    Each workspace gets its own directory so archives and summaries don't collide.
+    :param settings: All settings
+    :param name: TFE Workspace Name
+    :return: True if the workspace succeeded
+    """
+    workspace = settings.tfeWorkspaces[name]
+    workspaceDirectory = os.path.abspath(os.path.join('tfe-dag', name))
+    os.makedirs(workspaceDirectory, exist_ok=True)
+
+    commonArguments = ['-tfeToken', settings.tfeToken,
+                       '-tfeHostName', settings.tfeHostName,
+                       '-tfeOrganizationName', settings.tfeOrganizationName,
+                       '-tfeWorkspaceName', name,
+                       '-tfePipelineState', settings.tfePipelineState]
+
+    planArguments = commonArguments + [
+        '-terraformWorkingDirectory',
+        os.path.abspath(os.path.join(settings.terraformWorkingDirectory, workspace.get('workingDirectory', ''))),
+        # Workspaces share the job's uploadedresult artifact, keep their archives apart
+        '-tfeArchiveContainerFolder', f'archive/{name}',
+        '-tfeArchiveChunkSizeMB', settings.tfeArchiveChunkSizeMB,
+        '-tfePreflightParse', settings.tfePreflightParse,
+        '-tfeMaxArchiveSizeMB', settings.tfeMaxArchiveSizeMB,
+        '-tfeMaxFileCount', settings.tfeMaxFileCount,
+        '-tfeRunTimeoutMinutes', settings.tfeRunTimeoutMinutes,
+        '-tfeRunTimeoutFactor', settings.tfeRunTimeoutFactor,
+        '-tfeSpeculativePlan', str(settings.tfeSpeculativePlan),
+        '-tfeDestroyPlan', str(settings.tfeDestroyPlan)]
+    ok, output = run_script(settings, name, 'tfe-run-plan.py', planArguments + get_deadline_arguments(settings), workspaceDirectory)
+    if not ok:
+        return False
+
+    # The plan script exits 0 whatever the plan's final status, so check the status it reports
+    runId = re.search(r'##vso\[task\.setvariable variable=tfeRunId;\](\S+)', output)
+    runStatus = re.search(r'##vso\[task\.setvariable variable=tfeRunStatus;\](\S+)', output)
+    if runId is None or runStatus is None:
+        print(f'##vso[task.logissue type=error]Workspace {name}: no TFE Run Id or Run Status found in plan output')
+        return False
+    if runStatus.group(1) in ['errored', 'canceled', 'force_canceled', 'discarded']:
+        print(f'##vso[task.logissue type=error]Workspace {name}: TFE Run Plan ended {runStatus.group(1)}')
+        return False
+    if settings.tfeSpeculativePlan:
+        return settings.cancelReason is None
+    if runStatus.group(1) == 'planned_and_finished':
+        # No changes, there is nothing to apply
+        print(f'##[command]Workspace {name}: no changes, not applying')
+        return True
+
+    if settings.cancelReason is None and settings.tfeDeadline.remaining_in_seconds() == 0:
+        settings.cancelReason = f'Deadline of {settings.tfeDeadlineMinutes} minutes reached'
+    if settings.cancelReason is not None:
+        # Don't leave the planned run waiting for confirmation and holding the workspace lock
+        with settings.outputLock:
+            print(f'##[warning]Workspace {name}: not applying, {settings.cancelReason}')
+            stop_run(settings.tfeHostName, settings.tfeToken, runId.group(1), settings.cancelReason)
+        return False
+
+    applyArguments = commonArguments + ['-tfeRunId', runId.group(1)]
+    ok, _ = run_script(settings, name, 'tfe-run-apply.py', applyArguments + get_deadline_arguments(settings), workspaceDirectory)
+    return ok
+
+
+def run_script(settings, name, script, arguments, workspaceDirectory):
+    """
+    Run one of the pipeline scripts and replay its output once it has finished,
+    so the logs of parallel workspaces are not interleaved.
+    :return: (succeeded, output)
+    """
+    with settings.processLock:
+        if settings.cancelReason is not None:
+            return False, ''
+        proc = subprocess.Popen([sys.executable, os.path.join(settings.scriptDirectory, script)] + arguments,
+                                cwd=workspaceDirectory,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+        settings.processes.add(proc)
+    output, _ = proc.communicate()
+    with settings.processLock:
+        settings.processes.discard(proc)
+
+    with settings.outputLock:
+        print(f'##[section]Workspace {name}: {script} (exit code {proc.returncode})')
+        print(output)
+        if proc.returncode != 0:
+            print(f'##vso[task.logissue type=error]Workspace {name}: {script} failed')
+    return proc.returncode == 0, output
+
+
+def get_deadline_arguments(settings):
+    """
+    Each script only gets what is left of the overall deadline at the time it starts.
+    :return: Arguments to pass to the script
+    """
+    remaining = settings.tfeDeadline.remaining_in_seconds()
+    if remaining is None:
+        return []
+    return ['-tfeDeadlineMinutes', str(max(remaining / 60, 0.01))]
+
+
+def install_signal_handlers(settings):
+    """
+    When the ADO job is cancelled or times out, stop starting workspaces and pass the signal on
+    to the running scripts, which cancel or discard their TFE Run before exiting.
+    """
+    def handler(signum, frame):
+        with settings.processLock:
+            settings.cancelReason = f'Received {signal.Signals(signum).name}'
+            for proc in settings.processes:
+                proc.send_signal(signal.SIGINT)
+
+    signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGTERM, handler)
+
+
+def create_summary(settings):
+    print(f'##[group]Creating Summary Markdown')
+
+    summary = []
+    print(f'##[command]Generating Workspace Results')
+    summary.append('## Workspaces\n\n')
+    if settings.tfeDestroyPlan:
+        summary.append(f'_Destroy_\n\n')
+    if settings.tfeSpeculativePlan:
+        summary.append(f'_Speculative Plan_\n\n')
+    summary.append('| Level | Workspace | Result |\n')
+    summary.append('| --- | --- | --- |\n')
+    for level, names in enumerate(settings.tfeRunOrder):
+        for name in names:
+            summary.append(f'| {level} | {name} | {settings.tfeResults[name]} |\n')
+
+    f = open("dagsummary.md", "w")
+    f.writelines(summary)
+    f.close()
+    print(f'##vso[task.uploadsummary]{os.getcwd()}/dagsummary.md')
+    print(f'##[endgroup]')
+    print()
+
+    if any(result != 'succeeded' for result in settings.tfeResults.values()):
+        raise Exception('One or more workspaces did not succeed')
+
+
+# Utility functions
+def get_run_order(dependsOn):
+    """
+    Group the workspaces into levels, each level only depends on the levels before it.
+    Exception if the dependencies contain a cycle.
+    :param dependsOn: Dictionary of workspace name to the set of workspace names it depends on
+    :return: List of lists of workspace names
+    """
+    levels = []
+    placed = set()
+    while len(placed) < len(dependsOn):
+        level = sorted(name for name, dependencies in dependsOn.items()
+                       if name not in placed and dependencies <= placed)
+        if not level:
+            exceptionMessage = f'Dependency cycle between workspaces: {", ".join(sorted(set(dependsOn) - placed))}'
+            print(f'##[error]Invalid Manifest: {exceptionMessage}')
+            raise Exception(exceptionMessage)
+        levels.append(level)
+        placed.update(level)
+    return levels
+
+
+# Only run when executed, so the tests can import the scheduling functions
+if __name__ == '__main__':
+    settings = parse_args(parser)
+
+    install_signal_handlers(settings)
+
+    load_manifest(settings)
+
+    run_workspaces(settings)
+
+    create_summary(settings)
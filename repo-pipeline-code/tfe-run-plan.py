@@ -1,14 +1,21 @@
 #!/usr/bin/python
 
 import argparse
+import hashlib
 import json
 import os
 import re
+import sys
 import tarfile
 import time
 
 import requests
 
+from tfe_archive_index import ArchiveIndex, split_file
+from tfe_preflight import PARSER_VERSION, PreflightCache, get_file_hash, get_file_kind, parse_file
+from tfe_run_cancel import Deadline, RunCancelled, cancel_run, install_signal_handlers
+from tfe_run_history import TIMED_OUT_STATUS, RunHistory, get_resource_counts, get_status_durations
+
 # Required, these can be set via arguments or environment variables
 parser = argparse.ArgumentParser(description='Perform a TFE Run Plan.')
 parser.add_argument('-tfeToken',
@@ -30,12 +37,42 @@ parser.add_argument('-terraformWorkingDirectory',
 parser.add_argument('-tfeArchiveFileName',
                     default='terraform.tar.gz',
                     help='The file name to create as the archive file.')
+parser.add_argument('-tfeArchiveContainerFolder',
+                    default='archive',
+                    help='The folder of the uploadedresult build artifact to publish the archive to.')
 parser.add_argument('-tfeSpeculativePlan',
                     default='False',
                     help="When True, trigger a speculative plan that can not be applied.")
 parser.add_argument('-tfeDestroyPlan',
                     default='False',
                     help="When True, trigger a destroy plan.")
+parser.add_argument('-tfeMaxArchiveSizeMB',
+                    default='100',
+                    help="Fail before archiving when the files to archive are larger than this in total.")
+parser.add_argument('-tfeMaxFileCount',
+                    default='10000',
+                    help="Fail before archiving when there are more files to archive than this.")
+parser.add_argument('-tfePreflightParse',
+                    default='True',
+                    help="True to fail on Terraform files that do not parse, Warn to only report them, False to skip parsing.")
+parser.add_argument('-tfeArchiveExpiryDays',
+                    default='20',
+                    help="Publish the archive again when it was last published longer ago than this, keep it below the ADO retention period.")
+parser.add_argument('-tfeArchiveChunkSizeMB',
+                    default='0',
+                    help="When greater than 0, publish archives larger than this as chunks of this size.")
+parser.add_argument('-tfePipelineState',
+                    default='tfepipelinestate.db',
+                    help="The pipeline state file (run history, published archive index, pre-flight parse cache) carried between builds.")
+parser.add_argument('-tfeDeadlineMinutes',
+                    default='0',
+                    help="When greater than 0, cancel or discard the TFE Run if the plan has not completed in this many minutes.")
+parser.add_argument('-tfeRunTimeoutMinutes',
+                    default='60',
+                    help="Minutes the plan may spend working (not waiting on the workspace lock, a TFE worker or a policy override) when there is not enough run history to predict it.")
+parser.add_argument('-tfeRunTimeoutFactor',
+                    default='3',
+                    help="Time out when the plan takes this many times longer than the slowest recent runs.")
 
 
 def parse_args(parser):
@@ -60,6 +97,7 @@ def parse_args(parser):
         raise
     # Print arguments for debugging
     print(f'##[debug]tfeArchiveFileName:{args.tfeArchiveFileName}')
+    print(f'##[debug]tfeArchiveContainerFolder:{args.tfeArchiveContainerFolder}')
     print(f'##[debug]terraformWorkingDirectory:{args.terraformWorkingDirectory}')
     print(f'##[debug]tfeToken:{args.tfeToken}')
     print(f'##[debug]tfeHostName:{args.tfeHostName}')
@@ -72,15 +110,121 @@ def parse_args(parser):
     print(f'##[debug]tfeSpeculativePlan:{args.tfeSpeculativePlan}')
     print(f'##[debug]tfeDestroyPlan:{args.tfeDestroyPlan}')
 
+    args.tfePipelineState = os.path.abspath(args.tfePipelineState)
+    args.tfeRunTimeoutMinutes = float(args.tfeRunTimeoutMinutes)
+    args.tfeRunTimeoutFactor = float(args.tfeRunTimeoutFactor)
+    print(f'##[debug]tfePipelineState:{args.tfePipelineState}')
+    print(f'##[debug]tfeRunTimeoutMinutes:{args.tfeRunTimeoutMinutes}')
+    print(f'##[debug]tfeRunTimeoutFactor:{args.tfeRunTimeoutFactor}')
+    args.tfeDeadlineMinutes = float(args.tfeDeadlineMinutes)
+    args.tfeDeadline = Deadline(args.tfeDeadlineMinutes)
+    print(f'##[debug]tfeDeadlineMinutes:{args.tfeDeadlineMinutes}')
+    args.tfeMaxArchiveSizeMB = float(args.tfeMaxArchiveSizeMB)
+    args.tfeMaxFileCount = int(args.tfeMaxFileCount)
+    print(f'##[debug]tfeMaxArchiveSizeMB:{args.tfeMaxArchiveSizeMB}')
+    print(f'##[debug]tfeMaxFileCount:{args.tfeMaxFileCount}')
+    args.tfePreflightParse = args.tfePreflightParse.lower()
+    if args.tfePreflightParse not in ['true', 'warn', 'false']:
+        raise Exception(f'Invalid tfePreflightParse "{args.tfePreflightParse}", expected True, Warn or False')
+    print(f'##[debug]tfePreflightParse:{args.tfePreflightParse}')
+    args.tfeArchiveExpiryDays = float(args.tfeArchiveExpiryDays)
+    print(f'##[debug]tfeArchiveExpiryDays:{args.tfeArchiveExpiryDays}')
+    args.tfeArchiveChunkSizeMB = float(args.tfeArchiveChunkSizeMB)
+    print(f'##[debug]tfeArchiveChunkSizeMB:{args.tfeArchiveChunkSizeMB}')
+
     # Build specific values
     args.adoBuildLink = f'{os.environ["SYSTEM_TEAMFOUNDATIONSERVERURI"]}{os.environ["SYSTEM_TEAMPROJECT"]}/_build/results?buildId={os.environ["BUILD_BUILDID"]}'
+    args.adoBuildId = os.environ["BUILD_BUILDID"]
+    args.adoBuildNumber = os.environ["BUILD_BUILDNUMBER"]
+    args.adoRepositoryName = os.environ["BUILD_REPOSITORY_NAME"]
+    args.adoSourceBranch = os.environ["BUILD_SOURCEBRANCH"]
     args.sleepInSeconds = 5
+    args.minimumTimeoutInSeconds = 300
+    args.slowRunFactor = 2
+    args.waitingStatuses = ['pending', 'plan_queued', 'policy_override']
+    args.tfeHistory = RunHistory(args.tfePipelineState)
 
     print(f'##[endgroup]')
     print()
     return args
 
 
+def preflight_check(settings):
+    """
+    Fail fast, before any TFE capacity is used, when the code directory is missing, too large,
+    or contains Terraform files that do not parse.
+    :param settings: All settings
+    :return: None
+    """
+    print(f'##[group]Pre-flight Check')
+
+    if not os.path.isdir(settings.terraformWorkingDirectory):
+        exceptionMessage = f'Terraform working directory "{settings.terraformWorkingDirectory}" does not exist'
+        print(f'##vso[task.logissue type=error]{exceptionMessage}')
+        raise Exception(exceptionMessage)
+
+    # Same walk as archive_files, so the limits apply to what would be archived
+    files = []
+    for root, dirs, names in os.walk(settings.terraformWorkingDirectory, topdown=True):
+        dirs[:] = sorted(d for d in dirs if d not in ['.git', '.terraform'])
+        files.extend(os.path.join(root, name) for name in sorted(names))
+    totalSize = sum(os.path.getsize(f) for f in files)
+    print(f'##[command]Files to archive: {len(files)}, total size: {totalSize} bytes')
+
+    errors = []
+    if len(files) > settings.tfeMaxFileCount:
+        errors.append(f'{len(files)} files to archive, more than the limit of {settings.tfeMaxFileCount}')
+    if totalSize > settings.tfeMaxArchiveSizeMB * 1024 * 1024:
+        errors.append(f'{totalSize} bytes to archive, more than the limit of {settings.tfeMaxArchiveSizeMB}MB')
+    terraformFiles = [f for f in files if f.endswith('.tf') or f.endswith('.tf.json')]
+    if not terraformFiles:
+        errors.append(f'No .tf files found in "{settings.terraformWorkingDirectory}"')
+    for error in errors:
+        print(f'##vso[task.logissue type=error]{error}')
+
+    if settings.tfePreflightParse == 'false':
+        print(f'##[command]Terraform parsing is turned off')
+    elif PARSER_VERSION is None and settings.tfePreflightParse == 'true':
+        # Failing on parse errors means nothing if nothing was parsed
+        errors.append(f'python-hcl2 is not installed, unable to parse the Terraform files (set -tfePreflightParse to Warn or False to skip)')
+        print(f'##vso[task.logissue type=error]{errors[-1]}')
+    elif PARSER_VERSION is None:
+        print(f'##vso[task.logissue type=warning]python-hcl2 is not installed, skipping Terraform parsing')
+    else:
+        print(f'##[command]Parsing {len(terraformFiles)} Terraform files with {PARSER_VERSION}')
+        cache = PreflightCache(settings.tfePipelineState)
+        cached = 0
+        for file in terraformFiles:
+            with open(file, 'rb') as f:
+                content = f.read()
+            fileHash = get_file_hash(content)
+            found, error = cache.find(fileHash, get_file_kind(file))
+            if found:
+                cached += 1
+            else:
+                error = parse_file(file, content)
+                cache.record(fileHash, get_file_kind(file), error)
+            if error is not None:
+                # The parser can lag behind Terraform's grammar, so parse failures may only be reported as warnings
+                issueType = 'error' if settings.tfePreflightParse == 'true' else 'warning'
+                location = ''.join(f';{k}={error[v]}' for k, v in [('linenumber', 'line'), ('columnnumber', 'column')]
+                                   if error[v] is not None and error[v] > 0)
+                print(f'##vso[task.logissue type={issueType};sourcepath={file}{location}]{error["message"]}')
+                if issueType == 'error':
+                    errors.append(f'{file}: {error["message"]}')
+        cache.close()
+        print(f'##[debug]Parse results from cache: {cached}/{len(terraformFiles)}')
+
+    if errors:
+        exceptionMessage = f'Pre-flight check failed with {len(errors)} error(s)'
+        print(f'##[error]{exceptionMessage}')
+        raise Exception(exceptionMessage)
+
+    print(f'##[command]Pre-flight check passed')
+    print(f'##[endgroup]')
+    print()
+
+
 def archive_files(settings):
     """
     Based on the code directory, archive all the files into a tar.gz
@@ -99,18 +243,26 @@ def archive_files(settings):
     os.chdir(settings.terraformWorkingDirectory)
 
     print(f'##[command]Generating the tar.gz file')
+    # Hash the file names and contents rather than the tar.gz, which changes with every checkout's timestamps
+    archiveHash = hashlib.sha256()
     tar = tarfile.open(archiveFullPath, "w:gz")
     for root, dirs, files in os.walk('./', topdown=True):
-        # skip any potential temp directories
-        dirs[:] = [d for d in dirs if d not in ['.git', '.terraform']]
+        # skip any potential temp directories, sort so the hash is stable
+        dirs[:] = sorted(d for d in dirs if d not in ['.git', '.terraform'])
 
-        for file in files:
+        for file in sorted(files):
             print(f'##[debug]Archiving File: {os.path.join(root, file)}')
             tar.add(os.path.join(root, file))
+            with open(os.path.join(root, file), 'rb') as f:
+                archiveHash.update(os.path.join(root, file).encode() + b'\0')
+                archiveHash.update(hashlib.sha256(f.read()).digest())
     tar.close()
 
-    print(f'##vso[artifact.upload containerfolder=archive;artifactname=uploadedresult;]{archiveFullPath}')
+    vars(settings)['tfeArchiveFullPath'] = archiveFullPath
+    vars(settings)['tfeArchiveHash'] = archiveHash.hexdigest()
+    print(f'##[debug]tfeArchiveHash: {settings.tfeArchiveHash}')
     print(f'##vso[task.setvariable variable=tfeArchiveFileName;]{settings.tfeArchiveFileName}')
+    print(f'##vso[task.setvariable variable=tfeArchiveHash;]{settings.tfeArchiveHash}')
 
     # Revert working directory back
     os.chdir(currentDirectory)
@@ -118,6 +270,54 @@ def archive_files(settings):
     print()
 
 
+def publish_archive(settings):
+    """
+    Publish the archive as a build artifact, only when this content is new for the repo and branch.
+    Otherwise publish a pointer to the build that already has it.
+    :param settings: All settings
+    :return: None
+    """
+    print(f'##[group]Publish Archive')
+
+    index = ArchiveIndex(settings.tfePipelineState)
+    previous = index.find(settings.adoRepositoryName, settings.adoSourceBranch, settings.tfeArchiveContainerFolder,
+                          settings.tfeArchiveHash, settings.tfeArchiveExpiryDays)
+    if previous is not None:
+        print(f'##[command]Archive unchanged since build {previous["buildNumber"]} ({previous["buildId"]}), publishing pointer')
+        pointerFullPath = f'{settings.tfeArchiveFullPath}.pointer.json'
+        with open(pointerFullPath, 'w') as f:
+            json.dump(previous, f, indent=2)
+        print(f'##vso[artifact.upload containerfolder={settings.tfeArchiveContainerFolder};artifactname=uploadedresult;]{pointerFullPath}')
+        index.close()
+        print(f'##[endgroup]')
+        print()
+        return
+
+    archiveSize = os.path.getsize(settings.tfeArchiveFullPath)
+    chunkSizeInBytes = int(settings.tfeArchiveChunkSizeMB * 1024 * 1024)
+    print(f'##[debug]archiveSize: {archiveSize}')
+    if 0 < chunkSizeInBytes < archiveSize:
+        print(f'##[command]Publishing archive as chunks of {chunkSizeInBytes} bytes')
+        chunks = split_file(settings.tfeArchiveFullPath, chunkSizeInBytes)
+        manifestFullPath = f'{settings.tfeArchiveFullPath}.chunks.json'
+        with open(manifestFullPath, 'w') as f:
+            json.dump({'hash': settings.tfeArchiveHash,
+                       'chunks': [{'file': os.path.basename(c), 'sha256': h} for c, h in chunks]}, f, indent=2)
+        for chunkFullPath, _ in chunks:
+            print(f'##vso[artifact.upload containerfolder={settings.tfeArchiveContainerFolder};artifactname=uploadedresult;]{chunkFullPath}')
+        print(f'##vso[artifact.upload containerfolder={settings.tfeArchiveContainerFolder};artifactname=uploadedresult;]{manifestFullPath}')
+    else:
+        print(f'##[command]Publishing archive')
+        print(f'##vso[artifact.upload containerfolder={settings.tfeArchiveContainerFolder};artifactname=uploadedresult;]{settings.tfeArchiveFullPath}')
+
+    # Later builds only point here once tfe-archive-confirm.py has run after this step succeeded, i.e. the upload worked
+    index.record(settings.adoRepositoryName, settings.adoSourceBranch, settings.tfeArchiveContainerFolder, settings.tfeArchiveHash,
+                 settings.adoBuildId, settings.adoBuildNumber, 'uploadedresult')
+    index.close()
+    print(f'##[endgroup]')
+    print()
+
+
 def get_workspace_id(settings):
     """
     Get TFE Workspace Id from Workspace Name
@@ -294,21 +494,58 @@ def wait_for_plan_complete(settings):
     print(f'##[command]Current Run Cost Estimate will occur: {settings.tfeIsCostEstimate}')
     print(f'##[command]Current Run Policy Check will occur: {settings.tfeIsPolicyCheck}')
 
+    # Use previous runs of this workspace to time the polls and the timeout
+    prediction = settings.tfeHistory.predict(settings.tfeWorkspaceName, 'plan')
+    if prediction is None:
+        print(f'##[command]Not enough run history to predict the plan duration')
+        timeoutInSeconds = settings.tfeRunTimeoutMinutes * 60
+    else:
+        print(f'##[command]Plan predicted to take {prediction.median:.0f}s (p95 {prediction.p95:.0f}s, {prediction.samples} runs)')
+        timeoutInSeconds = prediction.timeout_in_seconds(settings.tfeRunTimeoutFactor, settings.minimumTimeoutInSeconds)
+    print(f'##[debug]Plan timeout: {timeoutInSeconds:.0f}s')
+
     # Loop until plan, cost estimate, and policy checks are all done (if applicable)
+    # Time spent waiting on the workspace lock, a free TFE worker, or a person to override a policy does not count
+    # towards the timeout, the prediction, or the recorded duration
+    lastPollTime = time.monotonic()
+    elapsed = 0
+    isSlowRun = False
     planDone = checkStatus(currentRunStatus, settings.tfeIsPolicyCheck, settings.tfeIsCostEstimate)
     while planDone is False:
-        time.sleep(settings.sleepInSeconds)
+        if elapsed > timeoutInSeconds:
+            exceptionMessage = f'TFE Run Plan did not complete within {timeoutInSeconds:.0f}s, status: {currentRunStatus}'
+            print(f'##[error]Run Plan Timeout: {exceptionMessage}')
+            # Record the timeout so the next prediction allows longer, plans may have legitimately grown
+            print(f'##[command]Recording plan timeout: {elapsed:.0f}s')
+            settings.tfeHistory.record(settings.tfeWorkspaceName, settings.tfeRunId, 'plan', TIMED_OUT_STATUS, elapsed,
+                                       get_status_durations(resp.json()['data']['attributes'].get('status-timestamps', {})),
+                                       get_resource_counts({}))
+            raise RunCancelled(exceptionMessage)
+        if prediction is not None and not isSlowRun and elapsed > prediction.median * settings.slowRunFactor:
+            isSlowRun = True
+            print(f'##vso[task.logissue type=warning]TFE Run Plan is much slower than usual, {elapsed:.0f}s so far vs a typical {prediction.median:.0f}s')
+
+        if prediction is None:
+            settings.tfeDeadline.sleep(settings.sleepInSeconds)
+        else:
+            settings.tfeDeadline.sleep(prediction.next_poll_in_seconds(elapsed, settings.sleepInSeconds))
         resp = requests.get(f'https://{settings.tfeHostName}/api/v2/runs/{settings.tfeRunId}',
                             headers={'Authorization': f'Bearer {settings.tfeToken}',
                                      'Content-Type': 'application/vnd.api+json'},
                             )
 
+        if currentRunStatus not in settings.waitingStatuses:
+            elapsed += time.monotonic() - lastPollTime
+        lastPollTime = time.monotonic()
         currentRunStatus = resp.json()['data']['attributes']['status']
         print(f'##[debug]Current Run Status: {currentRunStatus}')
         planDone = checkStatus(currentRunStatus, settings.tfeIsPolicyCheck, settings.tfeIsCostEstimate)
     print(f'##[command]Plan has completed, status: {currentRunStatus}')
-    # print(f'##[debug]aaa')
-    # print(f'##[debug]aaa')
+
+    vars(settings)['tfeRunStatus'] = currentRunStatus
+    print(f'##vso[task.setvariable variable=tfeRunStatus;]{settings.tfeRunStatus}')
+    vars(settings)['tfeRunDuration'] = elapsed
+    vars(settings)['tfeStatusDurations'] = get_status_durations(resp.json()['data']['attributes'].get('status-timestamps', {}))
 
     print(f'##[endgroup]')
     print()
@@ -325,6 +562,7 @@ def get_run_plan_logs(settings):
     print(f'##[debug]getPlanLogsUrlResponse: {resp.text}')
 
     vars(settings)['planLogsUrl'] = resp.json()['data']['attributes']['log-read-url']
+    vars(settings)['tfeResourceCounts'] = get_resource_counts(resp.json()['data']['attributes'])
 
     print(f'##[command]Getting Run Plan Logs')
     resp = requests.get(settings.planLogsUrl,
@@ -434,6 +672,20 @@ def create_summary(settings):
     print()
 
 
+def record_run_history(settings):
+    print(f'##[group]Record Run History')
+
+    print(f'##[command]Recording plan duration: {settings.tfeRunDuration:.0f}s')
+    print(f'##[debug]tfeStatusDurations: {settings.tfeStatusDurations}')
+    print(f'##[debug]tfeResourceCounts: {settings.tfeResourceCounts}')
+    settings.tfeHistory.record(settings.tfeWorkspaceName, settings.tfeRunId, 'plan', settings.tfeRunStatus,
+                               settings.tfeRunDuration, settings.tfeStatusDurations, settings.tfeResourceCounts)
+    settings.tfeHistory.close()
+
+    print(f'##[endgroup]')
+    print()
+
+
 # Utility functions
 def checkStatus(status, tfeIsPolicyCheck, tfeIsCostEstimate):
     """
@@ -489,22 +741,35 @@ def printLogs(logs):
 
 settings = parse_args(parser)
 
-archive_files(settings)
+# Stop the TFE Run if the ADO job is cancelled, times out, or the deadline is reached
+install_signal_handlers()
+
+try:
+    preflight_check(settings)
+
+    archive_files(settings)
+
+    publish_archive(settings)
+
+    get_workspace_id(settings)
 
-get_workspace_id(settings)
+    create_configuration_version(settings)
 
-create_configuration_version(settings)
+    create_run_plan(settings)
 
-create_run_plan(settings)
+    create_run_comment(settings)
 
-create_run_comment(settings)
+    wait_for_plan_complete(settings)
 
-wait_for_plan_complete(settings)
+    get_run_plan_logs(settings)
 
-get_run_plan_logs(settings)
+    record_run_history(settings)
 
-get_run_cost_estimate_logs(settings)
+    get_run_cost_estimate_logs(settings)
 
-get_run_policy_check_logs(settings)
+    get_run_policy_check_logs(settings)
 
-create_summary(settings)
+    create_summary(settings)
+except RunCancelled as e:
+    cancel_run(settings, e)
+    sys.exit(1)
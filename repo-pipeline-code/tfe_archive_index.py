@@ -0,0 +1,88 @@
+"""
+Shared helpers to only publish the Terraform archive when its content has not been published before.
+
+The index lives in the pipeline state file, the same SQLite file as the run history (see tfe_run_history.py),
+so it is carried from build to build by the same pipeline artifact. Entries are only used once the step that
+uploaded the archive has succeeded (see tfe-archive-confirm.py), and expire well before ADO retention
+deletes the build they point to, after which the archive is published again.
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+
+
+class ArchiveIndex:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS archives (
+                repository TEXT NOT NULL,
+                branch TEXT NOT NULL,
+                container_folder TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                build_id TEXT NOT NULL,
+                build_number TEXT NOT NULL,
+                artifact TEXT NOT NULL,
+                recorded_at REAL NOT NULL,
+                confirmed INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (repository, branch, container_folder, hash)
+            )""")
+        self.connection.commit()
+
+    def find(self, repository, branch, containerFolder, archiveHash, expiryDays):
+        """
+        Find the build that already published an archive with this content to this artifact folder.
+        :param expiryDays: Ignore archives published longer ago than this, their build may have been deleted by retention
+        :return: Dictionary describing the earlier artifact, or None if the content is new or expired
+        """
+        row = self.connection.execute(
+            'SELECT build_id, build_number, artifact FROM archives '
+            'WHERE repository = ? AND branch = ? AND container_folder = ? AND hash = ? AND recorded_at > ? AND confirmed = 1',
+            (repository, branch, containerFolder, archiveHash, time.time() - expiryDays * 24 * 60 * 60)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'repository': repository, 'branch': branch, 'hash': archiveHash,
+                'buildId': row[0], 'buildNumber': row[1], 'artifact': row[2], 'containerFolder': containerFolder}
+
+    def record(self, repository, branch, containerFolder, archiveHash, buildId, buildNumber, artifact):
+        """
+        Record an archive as being uploaded by this build, it is not found until the upload is confirmed.
+        """
+        self.connection.execute('INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)',
+                                (repository, branch, containerFolder, archiveHash, buildId, buildNumber, artifact, time.time()))
+        self.connection.commit()
+
+    def confirm(self, buildId):
+        """
+        Confirm the archives recorded by a build once the step that uploaded them has succeeded.
+        :return: Number of archives confirmed
+        """
+        count = self.connection.execute('UPDATE archives SET confirmed = 1 WHERE build_id = ? AND confirmed = 0',
+                                        (buildId,)).rowcount
+        self.connection.commit()
+        return count
+
+    def close(self):
+        self.connection.close()
+
+
+def split_file(path, chunkSizeInBytes):
+    """
+    Split a file into numbered chunks next to it, i.e. terraform.tar.gz.part000
+    :return: List of (chunk path, sha256) in order
+    """
+    chunks = []
+    with open(path, 'rb') as f:
+        data = f.read(chunkSizeInBytes)
+        while data:
+            chunkPath = f'{path}.part{len(chunks):03d}'
+            with open(chunkPath, 'wb') as chunk:
+                chunk.write(data)
+            chunks.append((chunkPath, hashlib.sha256(data).hexdigest()))
+            data = f.read(chunkSizeInBytes)
+    return chunks
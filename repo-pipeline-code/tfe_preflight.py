@@ -0,0 +1,87 @@
+"""
+Shared helpers to validate the Terraform code locally before any TFE capacity is used.
+
+Parse results are cached by file hash in the pipeline state file, the same SQLite file as the run history (see tfe_run_history.py),
+so unchanged files are not parsed again on the next build.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+try:
+    import hcl2
+except ImportError:
+    hcl2 = None
+
+PARSER_VERSION = f'python-hcl2 {getattr(hcl2, "__version__", "unknown")}' if hcl2 is not None else None
+
+
+class PreflightCache:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS preflight (
+                hash TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                parser TEXT NOT NULL,
+                error TEXT,
+                recorded_at REAL NOT NULL,
+                PRIMARY KEY (hash, kind, parser)
+            )""")
+        self.connection.commit()
+
+    def find(self, fileHash, kind):
+        """
+        :param kind: The file kind from get_file_kind, the same content can be valid as one kind and not the other
+        :return: (found, error), error is None when the file parsed
+        """
+        row = self.connection.execute('SELECT error FROM preflight WHERE hash = ? AND kind = ? AND parser = ?',
+                                      (fileHash, kind, PARSER_VERSION)).fetchone()
+        if row is None:
+            return False, None
+        return True, json.loads(row[0]) if row[0] is not None else None
+
+    def record(self, fileHash, kind, error):
+        self.connection.execute('INSERT OR REPLACE INTO preflight VALUES (?, ?, ?, ?, ?)',
+                                (fileHash, kind, PARSER_VERSION, json.dumps(error) if error is not None else None, time.time()))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def parse_file(path, content):
+    """
+    Parse a .tf or .tf.json file.
+    :return: None if the file parsed, otherwise a dictionary with the message, line and column
+    """
+    try:
+        if get_file_kind(path) == 'json':
+            json.loads(content)
+        else:
+            hcl2.loads(content.decode('utf-8'))
+    except json.JSONDecodeError as e:
+        return {'message': e.msg, 'line': e.lineno, 'column': e.colno}
+    except UnicodeDecodeError as e:
+        return {'message': f'File is not valid UTF-8: {e.reason}', 'line': None, 'column': None}
+    except Exception as e:
+        # lark parse errors carry the position, keep only the first line of the message
+        return {'message': str(e).splitlines()[0] if str(e) else type(e).__name__,
+                'line': getattr(e, 'line', None), 'column': getattr(e, 'column', None)}
+    return None
+
+
+def get_file_kind(path):
+    """
+    :return: 'json' for .tf.json files, 'tf' otherwise
+    """
+    return 'json' if path.endswith('.json') else 'tf'
+
+
+def get_file_hash(content):
+    return hashlib.sha256(content).hexdigest()
@@ -0,0 +1,129 @@
+"""
+Shared helpers to stop the TFE Run when the ADO job is cancelled, times out, or runs past its deadline.
+
+Without this the python process dies but the TFE Run keeps going, holding a concurrency slot and
+often the workspace lock until someone discards it by hand.
+"""
+
+import json
+import signal
+import time
+
+import requests
+
+# Runs waiting on a confirmation can only be discarded, runs that are working can only be canceled
+DISCARDABLE_STATUSES = ['pending', 'planned', 'cost_estimated', 'policy_checked', 'policy_override', 'policy_soft_failed']
+FINAL_STATUSES = ['applied', 'planned_and_finished', 'discarded', 'errored', 'canceled', 'force_canceled']
+
+
+class RunCancelled(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, minutes):
+        """
+        :param minutes: Minutes from now, 0 for no deadline
+        """
+        self.minutes = minutes
+        self.expiresAt = time.monotonic() + minutes * 60 if minutes > 0 else None
+
+    def remaining_in_seconds(self):
+        if self.expiresAt is None:
+            return None
+        return max(0, self.expiresAt - time.monotonic())
+
+    def check(self):
+        if self.expiresAt is not None and time.monotonic() >= self.expiresAt:
+            raise RunCancelled(f'Deadline of {self.minutes} minutes reached')
+
+    def sleep(self, seconds):
+        """
+        Sleep, but never past the deadline.
+        """
+        remaining = self.remaining_in_seconds()
+        time.sleep(seconds if remaining is None else min(seconds, remaining))
+        self.check()
+
+
+def install_signal_handlers():
+    """
+    ADO sends SIGINT when a job is cancelled or times out, then SIGTERM if the process is still around.
+    Turn both into RunCancelled so the run can be stopped before the process exits.
+    """
+    def handler(signum, frame):
+        raise RunCancelled(f'Received {signal.Signals(signum).name}')
+
+    signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGTERM, handler)
+
+
+def cancel_run(settings, reason):
+    """
+    Cancel or discard the in-flight TFE Run, depending on its status.
+    Errors are reported but not raised, the process is exiting anyway.
+    :param settings: All settings, tfeRunId is only set once a run exists
+    :param reason: Why the run is being stopped
+    :return: None
+    """
+    # Don't let a second signal interrupt the cancellation itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    print(f'##[group]Cancel Run')
+    print(f'##vso[task.logissue type=warning]Stopping TFE Run: {reason}')
+    if 'tfeRunId' not in vars(settings):
+        print(f'##[command]No TFE Run has been created, nothing to cancel')
+    else:
+        stop_run(settings.tfeHostName, settings.tfeToken, settings.tfeRunId, reason)
+
+    print(f'##[endgroup]')
+    print()
+
+
+def stop_run(tfeHostName, tfeToken, tfeRunId, reason, retryForSeconds=60, retryInSeconds=5):
+    """
+    Cancel or discard a TFE Run, depending on its status. Safe to call from any thread.
+    A run between states (i.e. 'confirmed' or 'apply_queued' right after an apply was requested) rejects both actions,
+    so keep polling and retry until it can be stopped, then fall back to a force-cancel.
+    Errors are reported but not raised.
+    :param retryForSeconds: How long to keep retrying a rejected action
+    :param retryInSeconds: Seconds between retries
+    """
+    headers = {'Authorization': f'Bearer {tfeToken}',
+               'Content-Type': 'application/vnd.api+json'}
+    data = json.dumps({'comment': f'Stopped from Azure DevOps: {reason}'})
+    try:
+        end = time.monotonic() + retryForSeconds
+        while True:
+            resp = requests.get(f'https://{tfeHostName}/api/v2/runs/{tfeRunId}', headers=headers, timeout=30)
+            currentRunStatus = resp.json()['data']['attributes']['status']
+            print(f'##[debug]Current Run Status: {currentRunStatus}')
+
+            if currentRunStatus in FINAL_STATUSES:
+                print(f'##[command]TFE Run is already finished, status: {currentRunStatus}')
+                return
+            action = 'discard' if currentRunStatus in DISCARDABLE_STATUSES else 'cancel'
+            print(f'##[command]Requesting TFE Run {action}')
+            resp = requests.post(f'https://{tfeHostName}/api/v2/runs/{tfeRunId}/actions/{action}',
+                                 headers=headers, data=data, timeout=30)
+            print(f'##[debug]postRunActionResponse: {resp.text}')
+            if resp.ok:
+                print(f'##[command]TFE Run {action} requested')
+                return
+            if time.monotonic() >= end:
+                break
+            print(f'##[warning]TFE Run {action} rejected while {currentRunStatus}, retrying in {retryInSeconds}s')
+            time.sleep(retryInSeconds)
+
+        # Only accepted once a cancel has been requested and TFE's cool-off has passed, but worth a last try
+        print(f'##[command]Requesting TFE Run force-cancel')
+        resp = requests.post(f'https://{tfeHostName}/api/v2/runs/{tfeRunId}/actions/force-cancel',
+                             headers=headers, data=data, timeout=30)
+        print(f'##[debug]postRunActionResponse: {resp.text}')
+        if resp.ok:
+            print(f'##[command]TFE Run force-cancel requested')
+        else:
+            print(f'##[error]TFE Run could not be stopped after {retryForSeconds}s, message: {resp.text}')
+    except Exception as e:
+        print(f'##[error]Unable to stop TFE Run {tfeRunId}: {e}')
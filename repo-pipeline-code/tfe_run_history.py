@@ -0,0 +1,126 @@
+"""
+Shared helpers to keep a history of TFE Run durations per workspace.
+
+The history is kept in the pipeline state file, a small SQLite file that the pipeline templates download
+from the previous build and publish again as a pipeline artifact, so each build knows how long a workspace usually takes.
+"""
+
+import json
+import os
+import sqlite3
+import statistics
+import time
+from datetime import datetime
+
+# Only the most recent runs are used to predict, older runs are less representative
+HISTORY_SAMPLE_SIZE = 20
+# Need at least this many runs before a prediction is trusted
+HISTORY_MINIMUM_SAMPLES = 3
+# Recorded for a phase stopped by its history-based timeout
+TIMED_OUT_STATUS = 'timed_out'
+
+
+class RunHistory:
+    def __init__(self, path):
+        self.path = path
+        # The first build of a pipeline has no state directory to download into
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS runs (
+                workspace TEXT NOT NULL,
+                run_id TEXT NOT NULL,
+                phase TEXT NOT NULL,
+                status TEXT NOT NULL,
+                duration REAL NOT NULL,
+                status_durations TEXT NOT NULL,
+                resource_counts TEXT NOT NULL,
+                recorded_at REAL NOT NULL
+            )""")
+        self.connection.commit()
+
+    def record(self, workspace, run_id, phase, status, duration, status_durations, resource_counts):
+        """
+        Append a finished run to the history.
+        :param workspace: TFE Workspace Name
+        :param run_id: TFE Run Id
+        :param phase: 'plan' or 'apply'
+        :param status: Final status of the phase, or TIMED_OUT_STATUS
+        :param duration: Seconds spent waiting for the phase to complete
+        :param status_durations: Dictionary of status to seconds spent in that status
+        :param resource_counts: Dictionary of resource additions/changes/destructions
+        :return: None
+        """
+        self.connection.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                (workspace, run_id, phase, status, duration,
+                                 json.dumps(status_durations), json.dumps(resource_counts), time.time()))
+        self.connection.commit()
+
+    def predict(self, workspace, phase):
+        """
+        Predict how long a phase will take based on the most recent successful or timed out runs.
+        A timed out run only tells us the phase takes at least that long, it is kept so the next timeout is longer.
+        :return: Prediction, or None when there is not enough history
+        """
+        rows = self.connection.execute(
+            'SELECT duration, status FROM runs WHERE workspace = ? AND phase = ? AND status NOT IN (?, ?, ?, ?) '
+            'ORDER BY recorded_at DESC LIMIT ?',
+            (workspace, phase, 'errored', 'discarded', 'canceled', 'force_canceled', HISTORY_SAMPLE_SIZE)
+        ).fetchall()
+        if len(rows) < HISTORY_MINIMUM_SAMPLES:
+            return None
+        return Prediction(sorted(row[0] for row in rows),
+                          max([row[0] for row in rows if row[1] == TIMED_OUT_STATUS], default=0))
+
+    def close(self):
+        self.connection.close()
+
+
+class Prediction:
+    def __init__(self, durations, timedOut=0):
+        """
+        :param durations: Sorted durations of the recent runs
+        :param timedOut: Longest recent duration that ended in a timeout, 0 if none
+        """
+        self.samples = len(durations)
+        self.timedOut = timedOut
+        self.median = statistics.median(durations)
+        self.p95 = durations[min(len(durations) - 1, int(round(0.95 * (len(durations) - 1))))]
+
+    def next_poll_in_seconds(self, elapsed, minimum, maximum=60):
+        """
+        Poll sparsely while the run is far from its predicted finish, then at the minimum interval.
+        :param elapsed: Seconds the phase has been running
+        :param minimum: Shortest interval between polls
+        :param maximum: Longest interval between polls
+        :return: Seconds to sleep before the next poll
+        """
+        remaining = self.median - elapsed
+        return max(minimum, min(maximum, remaining / 2))
+
+    def timeout_in_seconds(self, factor, minimum):
+        # Grow past a recent timeout, otherwise a workspace whose runs have legitimately grown would time out for good
+        return max(minimum, max(self.p95, self.timedOut) * factor)
+
+
+def get_status_durations(statusTimestamps):
+    """
+    Convert the run 'status-timestamps' attribute into the seconds spent in each status.
+    The last status has no end, so it is not included.
+    :param statusTimestamps: Dictionary of '<status>-at' to ISO 8601 timestamp
+    :return: Dictionary of status to seconds
+    """
+    timestamps = sorted(
+        (datetime.fromisoformat(value.replace('Z', '+00:00')), key[:-len('-at')].replace('-', '_'))
+        for key, value in statusTimestamps.items() if key.endswith('-at') and value)
+    return {status: (end - start).total_seconds()
+            for (start, status), (end, _) in zip(timestamps, timestamps[1:])}
+
+
+def get_resource_counts(attributes):
+    """
+    Pull the resource counts out of plan or apply attributes.
+    :param attributes: The 'attributes' of a plan or apply
+    :return: Dictionary of resource additions/changes/destructions
+    """
+    return {k: attributes.get(k) for k in ['resource-additions', 'resource-changes', 'resource-destructions']}
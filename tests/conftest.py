@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from fake_tfe_server import SCRIPTS_DIRECTORY, FakeTfe
+
+# The shared helper modules sit next to the scripts
+sys.path.insert(0, SCRIPTS_DIRECTORY)
+
+
+@pytest.fixture(scope='session')
+def fake_tfe_certificate(tmp_path_factory):
+    """
+    The scripts always talk https, generate a self-signed localhost certificate for the fake TFE server.
+    :return: (certificate path, key path)
+    """
+    directory = tmp_path_factory.mktemp('fake_tfe_certificate')
+    certificate = str(directory / 'cert.pem')
+    key = str(directory / 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                    '-keyout', key, '-out', certificate, '-days', '1',
+                    '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost'],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certificate, key
+
+
+@pytest.fixture
+def fake_tfe(fake_tfe_certificate):
+    fakes = []
+
+    def start(runStatus, **kwargs):
+        fakes.append(FakeTfe(runStatus, *fake_tfe_certificate, **kwargs))
+        return fakes[-1]
+
+    yield start
+    for fake in fakes:
+        fake.close()
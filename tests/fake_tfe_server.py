@@ -0,0 +1,139 @@
+"""
+Just enough of the TFE API to run tfe-run-plan.py and tfe-run-apply.py against, over https on localhost.
+"""
+
+import json
+import os
+import ssl
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TESTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIRECTORY = os.path.join(os.path.dirname(TESTS_DIRECTORY), 'repo-pipeline-code')
+DISCARDABLE_STATUSES = ['pending', 'planned', 'cost_estimated', 'policy_checked', 'policy_override', 'policy_soft_failed']
+
+
+class FakeTfe:
+    """
+    A single run, runId 'run-1', in any workspace of organization 'org'.
+    When applied the run moves through afterApply, one status per poll of the run.
+    Like TFE, a cancel is only accepted while planning or applying and a discard only while waiting,
+    otherwise the action is rejected with a 409.
+    """
+
+    def __init__(self, runStatus, certificate, key, afterApply=('applying',)):
+        self.runStatus = runStatus
+        self.afterApply = list(afterApply)
+        self.nextStatuses = []
+        self.certificate = certificate
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.requests.append(('GET', self.path))
+                if self.path.startswith('/api/v2/organizations/org/workspaces/'):
+                    self.send_json({'data': {'id': 'ws-1'}})
+                elif self.path == '/api/v2/runs/run-1':
+                    if fake.nextStatuses:
+                        fake.runStatus = fake.nextStatuses.pop(0)
+                    self.send_json({'data': {'id': 'run-1',
+                                             'attributes': {'status': fake.runStatus, 'status-timestamps': {}},
+                                             'relationships': {'policy-checks': {'data': []}}}})
+                elif self.path in ['/api/v2/plans/plan-1', '/api/v2/runs/run-1/apply']:
+                    self.send_json({'data': {'attributes': {
+                        'log-read-url': f'https://localhost:{fake.port}/logs',
+                        'resource-additions': 0, 'resource-changes': 0, 'resource-destructions': 0}}})
+                elif self.path == '/logs':
+                    self.send_json('Terraform logs')
+                else:
+                    self.send_json({}, 404)
+
+            def do_PUT(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                fake.requests.append(('PUT', self.path))
+                self.send_json({})
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                fake.requests.append(('POST', self.path))
+                if self.path == '/api/v2/workspaces/ws-1/configuration-versions':
+                    self.send_json({'data': {'id': 'cv-1', 'attributes': {
+                        'upload-url': f'https://localhost:{fake.port}/upload'}}})
+                elif self.path == '/api/v2/runs':
+                    self.send_json({'data': {'id': 'run-1', 'relationships': {'plan': {'data': {'id': 'plan-1'}}}}})
+                elif self.path == '/api/v2/runs/run-1/actions/apply':
+                    fake.runStatus = fake.afterApply[0]
+                    fake.nextStatuses = fake.afterApply[1:]
+                    self.send_json({})
+                elif self.path == '/api/v2/runs/run-1/actions/cancel' and fake.runStatus in ['planning', 'applying']:
+                    fake.runStatus = 'canceled'
+                    self.send_json({})
+                elif self.path == '/api/v2/runs/run-1/actions/discard' and fake.runStatus in DISCARDABLE_STATUSES:
+                    fake.runStatus = 'discarded'
+                    self.send_json({})
+                elif self.path.startswith('/api/v2/runs/run-1/actions/'):
+                    self.send_json({'errors': [{'status': '409', 'title': 'transition not allowed'}]}, 409)
+                else:
+                    self.send_json({})
+
+            def send_json(self, body, code=200):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/vnd.api+json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('localhost', 0), Handler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certificate, key)
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def posts(self):
+        return [path for method, path in self.requests if method == 'POST']
+
+    def wait_for(self, request, timeout=30):
+        end = time.monotonic() + timeout
+        while request not in self.requests:
+            assert time.monotonic() < end, f'{request} was never requested, requests: {self.requests}'
+            time.sleep(0.1)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_script(tmp_path, fake, script, arguments, env=None):
+    """
+    Start one of the pipeline scripts against the fake, with the environment an ADO build provides.
+    :param env: Extra environment variables
+    """
+    env = dict(os.environ,
+               **(env or {}),
+               REQUESTS_CA_BUNDLE=fake.certificate,
+               SYSTEM_TEAMFOUNDATIONSERVERURI='https://dev.azure.com/org/',
+               SYSTEM_TEAMPROJECT='project',
+               BUILD_BUILDID='1',
+               BUILD_BUILDNUMBER='20200101.1',
+               BUILD_REPOSITORY_NAME='terraform-code',
+               BUILD_SOURCEBRANCH='refs/heads/master')
+    return subprocess.Popen([sys.executable, os.path.join(SCRIPTS_DIRECTORY, script),
+                             '-tfeToken', 'token',
+                             '-tfeHostName', f'localhost:{fake.port}',
+                             '-tfeOrganizationName', 'org',
+                             '-tfePipelineState', str(tmp_path / 'tfepipelinestate.db')] + arguments,
+                            cwd=str(tmp_path),
+                            env=env,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                            universal_newlines=True)
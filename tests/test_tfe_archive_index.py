@@ -0,0 +1,77 @@
+"""
+Check the index of published archives and the chunking of large archives.
+"""
+
+import os
+import subprocess
+import sys
+
+from fake_tfe_server import SCRIPTS_DIRECTORY
+from tfe_archive_index import ArchiveIndex, split_file
+
+
+def make_index(tmp_path):
+    index = ArchiveIndex(str(tmp_path / 'tfepipelinestate.db'))
+    index.record('repo', 'refs/heads/master', 'archive', 'hash-1', '7', '20200101.7', 'uploadedresult')
+    return index
+
+
+def test_find_confirmed_archive(tmp_path):
+    index = make_index(tmp_path)
+    assert index.confirm('7') == 1
+    assert index.find('repo', 'refs/heads/master', 'archive', 'hash-1', 20) == {
+        'repository': 'repo', 'branch': 'refs/heads/master', 'hash': 'hash-1',
+        'buildId': '7', 'buildNumber': '20200101.7', 'artifact': 'uploadedresult', 'containerFolder': 'archive'}
+    index.close()
+
+
+def test_unconfirmed_archive_is_not_found(tmp_path):
+    # The step that uploaded it has not succeeded (yet), the artifact may not exist
+    index = make_index(tmp_path)
+    assert index.find('repo', 'refs/heads/master', 'archive', 'hash-1', 20) is None
+    assert index.confirm('8') == 0
+    assert index.find('repo', 'refs/heads/master', 'archive', 'hash-1', 20) is None
+    index.close()
+
+
+def test_find_misses_other_branch_folder_or_content(tmp_path):
+    index = make_index(tmp_path)
+    index.confirm('7')
+    assert index.find('repo', 'refs/heads/feature', 'archive', 'hash-1', 20) is None
+    assert index.find('repo', 'refs/heads/master', 'archive/network', 'hash-1', 20) is None
+    assert index.find('other-repo', 'refs/heads/master', 'archive', 'hash-1', 20) is None
+    assert index.find('repo', 'refs/heads/master', 'archive', 'hash-2', 20) is None
+    index.close()
+
+
+def test_expired_archive_is_not_found(tmp_path):
+    index = make_index(tmp_path)
+    index.confirm('7')
+    index.connection.execute("UPDATE archives SET recorded_at = recorded_at - 21 * 24 * 60 * 60")
+    index.connection.commit()
+    assert index.find('repo', 'refs/heads/master', 'archive', 'hash-1', 20) is None
+    assert index.find('repo', 'refs/heads/master', 'archive', 'hash-1', 30) is not None
+    index.close()
+
+
+def test_confirm_script_confirms_this_build(tmp_path):
+    make_index(tmp_path).close()
+    output = subprocess.run([sys.executable, os.path.join(SCRIPTS_DIRECTORY, 'tfe-archive-confirm.py'),
+                             '-tfePipelineState', str(tmp_path / 'tfepipelinestate.db')],
+                            env=dict(os.environ, BUILD_BUILDID='7'), check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True).stdout
+    assert 'Archives confirmed for build 7: 1' in output
+    index = ArchiveIndex(str(tmp_path / 'tfepipelinestate.db'))
+    assert index.find('repo', 'refs/heads/master', 'archive', 'hash-1', 20) is not None
+    index.close()
+
+
+def test_split_file_round_trip(tmp_path):
+    archive = tmp_path / 'terraform.tar.gz'
+    content = os.urandom(2500)
+    archive.write_bytes(content)
+    chunks = split_file(str(archive), 1000)
+    assert [os.path.basename(path) for path, _ in chunks] == [
+        'terraform.tar.gz.part000', 'terraform.tar.gz.part001', 'terraform.tar.gz.part002']
+    assert [os.path.getsize(path) for path, _ in chunks] == [1000, 1000, 500]
+    assert b''.join(open(path, 'rb').read() for path, _ in chunks) == content
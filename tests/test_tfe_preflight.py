@@ -0,0 +1,103 @@
+"""
+Run the pre-flight check of tfe-run-plan.py against the local fake TFE server, see fake_tfe_server.py.
+"""
+
+import os
+import sqlite3
+
+import pytest
+
+from fake_tfe_server import start_script
+
+
+def run_plan(tmp_path, fake, files, arguments=(), env=None):
+    code = tmp_path / 'code'
+    code.mkdir(exist_ok=True)
+    for name, content in files.items():
+        (code / name).write_bytes(content)
+    proc = start_script(tmp_path, fake, 'tfe-run-plan.py', ['-tfeWorkspaceName', 'ws',
+                                                            '-terraformWorkingDirectory', str(code)] + list(arguments), env)
+    output, _ = proc.communicate(timeout=60)
+    return proc.returncode, output
+
+
+def hide_hcl2(tmp_path):
+    # Shadow the installed python-hcl2 with a module that fails to import
+    directory = tmp_path / 'nohcl2'
+    directory.mkdir()
+    (directory / 'hcl2.py').write_text("raise ImportError('hidden by the test')\n")
+    return {'PYTHONPATH': str(directory)}
+
+
+def test_missing_parser_fails_when_parse_errors_fail(tmp_path, fake_tfe):
+    fake = fake_tfe('planned_and_finished')
+    returncode, output = run_plan(tmp_path, fake, {'main.tf': b'x = 1\n'}, env=hide_hcl2(tmp_path))
+    assert returncode == 1, output
+    assert '##vso[task.logissue type=error]python-hcl2 is not installed' in output
+    assert not os.path.exists(tmp_path / 'terraform.tar.gz')
+    assert fake.requests == []
+
+
+def test_missing_parser_warns_when_parse_errors_warn(tmp_path, fake_tfe):
+    fake = fake_tfe('planned_and_finished')
+    returncode, output = run_plan(tmp_path, fake, {'main.tf': b'x = 1\n'}, ['-tfePreflightParse', 'Warn'], hide_hcl2(tmp_path))
+    assert returncode == 0, output
+    assert '##vso[task.logissue type=warning]python-hcl2 is not installed' in output
+
+
+def test_tf_syntax_error_location(tmp_path, fake_tfe):
+    fake = fake_tfe('planned_and_finished')
+    returncode, output = run_plan(tmp_path, fake, {'main.tf': b'resource "a" "b" {\n  x = \n}\n'})
+    assert returncode == 1, output
+    sourcepath = os.path.join(str(tmp_path / 'code'), 'main.tf')
+    assert f'##vso[task.logissue type=error;sourcepath={sourcepath};linenumber=2;columnnumber=7]' in output
+    assert fake.requests == []
+
+
+def test_json_syntax_error_location(tmp_path, fake_tfe):
+    fake = fake_tfe('planned_and_finished')
+    returncode, output = run_plan(tmp_path, fake, {'main.tf.json': b'{\n  "a": }\n'})
+    assert returncode == 1, output
+    sourcepath = os.path.join(str(tmp_path / 'code'), 'main.tf.json')
+    assert f'##vso[task.logissue type=error;sourcepath={sourcepath};linenumber=2;columnnumber=8]Expecting value' in output
+
+
+def test_same_content_is_cached_per_file_kind(tmp_path, fake_tfe):
+    # An empty .tf is valid hcl, an empty .tf.json is not valid json
+    fake = fake_tfe('planned_and_finished')
+    returncode, output = run_plan(tmp_path, fake, {'empty.tf': b'', 'empty.tf.json': b''})
+    assert returncode == 1, output
+    assert 'sourcepath=' + os.path.join(str(tmp_path / 'code'), 'empty.tf.json') in output
+    assert 'sourcepath=' + os.path.join(str(tmp_path / 'code'), 'empty.tf;') not in output
+
+    connection = sqlite3.connect(str(tmp_path / 'tfepipelinestate.db'))
+    rows = connection.execute('SELECT hash, kind, error IS NULL FROM preflight ORDER BY kind').fetchall()
+    connection.close()
+    assert [(kind, parsed) for _, kind, parsed in rows] == [('json', 0), ('tf', 1)]
+    assert rows[0][0] == rows[1][0]
+
+
+def test_unchanged_files_are_parsed_from_cache(tmp_path, fake_tfe):
+    fake = fake_tfe('planned_and_finished')
+    files = {'main.tf': b'resource "null_resource" "example" {}\n'}
+    returncode, output = run_plan(tmp_path, fake, files)
+    assert returncode == 0, output
+    assert 'Parse results from cache: 0/1' in output
+    returncode, output = run_plan(tmp_path, fake, files)
+    assert returncode == 0, output
+    assert 'Parse results from cache: 1/1' in output
+
+
+@pytest.mark.parametrize('arguments, error', [
+    (['-tfeMaxFileCount', '1'], '2 files to archive, more than the limit of 1'),
+    (['-tfeMaxArchiveSizeMB', '0.00001'], 'bytes to archive, more than the limit of 1e-05MB'),
+])
+def test_limits_fail_before_archiving(tmp_path, fake_tfe, arguments, error):
+    fake = fake_tfe('planned_and_finished')
+    returncode, output = run_plan(tmp_path, fake, {'main.tf': b'resource "null_resource" "example" {}\n',
+                                                   'variables.tf': b'variable "name" {}\n'}, arguments)
+    assert returncode == 1, output
+    assert '##vso[task.logissue type=error]' in output and error in output
+    assert '##[group]Archive Files' not in output
+    assert not os.path.exists(tmp_path / 'terraform.tar.gz')
+    assert fake.requests == []
@@ -0,0 +1,76 @@
+"""
+Run tfe-run-plan.py and tfe-run-apply.py against a local fake TFE server and check that a cancelled
+ADO job (SIGTERM) or a reached -tfeDeadlineMinutes stops the TFE Run through the actions API.
+
+The fake server is in fake_tfe_server.py, its self-signed localhost certificate is generated at test time (see conftest.py).
+"""
+
+import signal
+
+from fake_tfe_server import start_script
+
+
+def start_plan(tmp_path, fake, arguments=()):
+    code = tmp_path / 'code'
+    code.mkdir()
+    (code / 'main.tf').write_text('resource "null_resource" "example" {}\n')
+    return start_script(tmp_path, fake, 'tfe-run-plan.py', ['-tfeWorkspaceName', 'ws', '-terraformWorkingDirectory', str(code)] + list(arguments))
+
+
+def start_apply(tmp_path, fake, arguments=()):
+    return start_script(tmp_path, fake, 'tfe-run-apply.py', ['-tfeWorkspaceName', 'ws', '-tfeRunId', 'run-1'] + list(arguments))
+
+
+def assert_stopped(proc, fake, action):
+    output, _ = proc.communicate(timeout=60)
+    assert proc.returncode == 1, output
+    assert 'Traceback' not in output, output
+    assert f'/api/v2/runs/run-1/actions/{action}' in fake.posts(), output
+    assert f'TFE Run {action} requested' in output
+
+
+def test_plan_sigterm_cancels_planning_run(tmp_path, fake_tfe):
+    fake = fake_tfe('planning')
+    proc = start_plan(tmp_path, fake)
+    fake.wait_for(('GET', '/api/v2/runs/run-1'))
+    proc.send_signal(signal.SIGTERM)
+    assert_stopped(proc, fake, 'cancel')
+
+
+def test_plan_sigterm_discards_pending_run(tmp_path, fake_tfe):
+    fake = fake_tfe('pending')
+    proc = start_plan(tmp_path, fake)
+    fake.wait_for(('GET', '/api/v2/runs/run-1'))
+    proc.send_signal(signal.SIGTERM)
+    assert_stopped(proc, fake, 'discard')
+
+
+def test_plan_deadline_cancels_planning_run(tmp_path, fake_tfe):
+    fake = fake_tfe('planning')
+    proc = start_plan(tmp_path, fake, ['-tfeDeadlineMinutes', '0.05'])
+    assert_stopped(proc, fake, 'cancel')
+
+
+def test_apply_sigterm_cancels_applying_run(tmp_path, fake_tfe):
+    fake = fake_tfe('planned')
+    proc = start_apply(tmp_path, fake)
+    fake.wait_for(('POST', '/api/v2/runs/run-1/actions/apply'))
+    proc.send_signal(signal.SIGTERM)
+    assert_stopped(proc, fake, 'cancel')
+
+
+def test_apply_deadline_cancels_applying_run(tmp_path, fake_tfe):
+    fake = fake_tfe('planned')
+    proc = start_apply(tmp_path, fake, ['-tfeDeadlineMinutes', '0.05'])
+    assert_stopped(proc, fake, 'cancel')
+
+
+def test_apply_sigterm_retries_cancel_while_confirmed(tmp_path, fake_tfe):
+    # SIGINT right after the apply was accepted, TFE rejects a cancel until the run is applying
+    fake = fake_tfe('planned', afterApply=['confirmed', 'confirmed', 'apply_queued', 'applying'])
+    proc = start_apply(tmp_path, fake)
+    fake.wait_for(('POST', '/api/v2/runs/run-1/actions/apply'))
+    proc.send_signal(signal.SIGTERM)
+    assert_stopped(proc, fake, 'cancel')
+    assert fake.posts().count('/api/v2/runs/run-1/actions/cancel') > 1
+    assert fake.runStatus == 'canceled'
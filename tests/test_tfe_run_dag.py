@@ -0,0 +1,117 @@
+"""
+Check the scheduling of tfe-run-dag.py directly, and run it against the local fake TFE server, see fake_tfe_server.py.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+
+import pytest
+
+from fake_tfe_server import SCRIPTS_DIRECTORY, start_script
+from tfe_run_cancel import Deadline
+
+# The script name is not a valid module name
+spec = importlib.util.spec_from_file_location('tfe_run_dag', os.path.join(SCRIPTS_DIRECTORY, 'tfe-run-dag.py'))
+tfe_run_dag = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(tfe_run_dag)
+
+
+def make_settings(tmp_path, workspaces, tfeDestroyPlan=False):
+    manifest = tmp_path / 'workspaces.json'
+    manifest.write_text(json.dumps({'workspaces': workspaces}))
+    settings = argparse.Namespace(tfeManifest=str(manifest), tfeDestroyPlan=tfeDestroyPlan, tfeMaxParallel=2,
+                                  tfeDeadlineMinutes=0, tfeDeadline=Deadline(0), cancelReason=None)
+    tfe_run_dag.load_manifest(settings)
+    return settings
+
+
+def test_run_order_levels():
+    assert tfe_run_dag.get_run_order({'network': set(),
+                                      'data': {'network'},
+                                      'dns': set(),
+                                      'app': {'network', 'data'}}) == [['dns', 'network'], ['data'], ['app']]
+
+
+def test_run_order_cycle():
+    with pytest.raises(Exception, match='Dependency cycle between workspaces: a, b'):
+        tfe_run_dag.get_run_order({'a': {'b'}, 'b': {'a'}, 'c': set()})
+
+
+def test_unknown_dependency(tmp_path):
+    with pytest.raises(Exception, match='depends on unknown workspace "missing"'):
+        make_settings(tmp_path, {'app': {'dependsOn': ['missing']}})
+
+
+def test_destroy_reverses_dependencies(tmp_path):
+    settings = make_settings(tmp_path, {'network': {},
+                                        'data': {'dependsOn': ['network']},
+                                        'app': {'dependsOn': ['network', 'data']}}, tfeDestroyPlan=True)
+    assert settings.tfeDependsOn == {'network': {'data', 'app'}, 'data': {'app'}, 'app': set()}
+    assert settings.tfeRunOrder == [['app'], ['data'], ['network']]
+
+
+def test_failed_workspace_skips_downstream(tmp_path, monkeypatch):
+    settings = make_settings(tmp_path, {'network': {},
+                                        'data': {'dependsOn': ['network']},
+                                        'app': {'dependsOn': ['data']},
+                                        'dns': {}})
+    started = []
+
+    def run_workspace(settings, name):
+        started.append(name)
+        return name != 'data'
+
+    monkeypatch.setattr(tfe_run_dag, 'run_workspace', run_workspace)
+    tfe_run_dag.run_workspaces(settings)
+    assert settings.tfeResults == {'network': 'succeeded', 'data': 'failed', 'app': 'skipped', 'dns': 'succeeded'}
+    assert 'app' not in started
+    assert started.index('network') < started.index('data')
+
+
+def start_dag(tmp_path, fake, arguments=()):
+    code = tmp_path / 'code'
+    for name in ['network', 'app']:
+        (code / name).mkdir(parents=True)
+        (code / name / 'main.tf').write_text('resource "null_resource" "example" {}\n')
+    manifest = tmp_path / 'workspaces.json'
+    manifest.write_text(json.dumps({'workspaces': {
+        'network': {'workingDirectory': 'network'},
+        'app': {'workingDirectory': 'app', 'dependsOn': ['network']}}}))
+    return start_script(tmp_path, fake, 'tfe-run-dag.py', ['-tfeManifest', str(manifest),
+                                                            '-terraformWorkingDirectory', str(code),
+                                                            '-tfeSpeculativePlan', 'False'] + list(arguments))
+
+
+def test_errored_plan_fails_the_workspace(tmp_path, fake_tfe):
+    # The plan script exits 0 for an errored plan, the DAG has to go by the reported status
+    fake = fake_tfe('errored')
+    proc = start_dag(tmp_path, fake)
+    output, _ = proc.communicate(timeout=120)
+    assert proc.returncode != 0, output
+    assert 'Workspace network: TFE Run Plan ended errored' in output
+    assert 'Workspace network failed' in output
+    assert 'Skipping workspace app, an upstream workspace did not succeed' in output
+    assert '/api/v2/runs/run-1/actions/apply' not in fake.posts()
+
+
+def test_plan_without_changes_succeeds_without_apply(tmp_path, fake_tfe):
+    fake = fake_tfe('planned_and_finished')
+    proc = start_dag(tmp_path, fake)
+    output, _ = proc.communicate(timeout=120)
+    assert proc.returncode == 0, output
+    assert 'Workspace network succeeded' in output
+    assert 'Workspace app succeeded' in output
+    assert 'tfe-run-apply.py' not in output
+    assert '/api/v2/runs/run-1/actions/apply' not in fake.posts()
+
+
+def test_archive_limits_reach_each_workspace(tmp_path, fake_tfe):
+    fake = fake_tfe('planned_and_finished')
+    proc = start_dag(tmp_path, fake, ['-tfeMaxFileCount', '0'])
+    output, _ = proc.communicate(timeout=120)
+    assert proc.returncode != 0, output
+    assert '1 files to archive, more than the limit of 0' in output
+    assert 'Workspace network failed' in output
+    assert fake.posts() == []
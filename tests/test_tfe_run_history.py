@@ -0,0 +1,45 @@
+"""
+Check that run history predictions, and the plan timeout they drive, grow past runs that timed out.
+"""
+
+import sqlite3
+
+from fake_tfe_server import start_script
+from tfe_run_history import TIMED_OUT_STATUS, RunHistory
+
+
+def record(history, status, duration):
+    history.record('ws', 'run-1', 'plan', status, duration, {}, {})
+
+
+def test_timeout_grows_past_timed_out_runs(tmp_path):
+    history = RunHistory(str(tmp_path / 'tfepipelinestate.db'))
+    for duration in [10, 10, 10]:
+        record(history, 'planned', duration)
+    assert history.predict('ws', 'plan').timeout_in_seconds(3, 0) == 30
+
+    record(history, TIMED_OUT_STATUS, 31)
+    assert history.predict('ws', 'plan').timeout_in_seconds(3, 0) == 93
+
+    # Failed runs say nothing about how long a plan takes
+    record(history, 'errored', 1000)
+    assert history.predict('ws', 'plan').timeout_in_seconds(3, 0) == 93
+    history.close()
+
+
+def test_plan_timeout_is_recorded(tmp_path, fake_tfe):
+    fake = fake_tfe('planning')
+    code = tmp_path / 'code'
+    code.mkdir()
+    (code / 'main.tf').write_text('resource "null_resource" "example" {}\n')
+    proc = start_script(tmp_path, fake, 'tfe-run-plan.py', ['-tfeWorkspaceName', 'ws',
+                                                            '-terraformWorkingDirectory', str(code),
+                                                            '-tfeRunTimeoutMinutes', '0.02'])
+    output, _ = proc.communicate(timeout=60)
+    assert proc.returncode == 1, output
+    assert 'Run Plan Timeout' in output
+    assert '/api/v2/runs/run-1/actions/cancel' in fake.posts()
+
+    connection = sqlite3.connect(str(tmp_path / 'tfepipelinestate.db'))
+    assert connection.execute('SELECT workspace, phase, status FROM runs').fetchall() == [('ws', 'plan', TIMED_OUT_STATUS)]
+    connection.close()